@@ -5,12 +5,24 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # Caminho padrão para o CSV com os dados brutos
 DATA_PATH = BASE_DIR / "data" / "AequitasDB.csv"
 
+# Diretório onde o último treino é persistido (reaproveitado no startup se o CSV não mudou)
+MODEL_CACHE_DIR = BASE_DIR / "data" / "model_cache"
+
 # Parâmetro de privacidade: mínimo de registros em qualquer grupo/cluster
 K_ANONYMITY = 10
 
 # Limite máximo de registros para uma consulta agregada
 MAX_RESULTS = 4000
 
+# Quantidade máxima de consultas memorizadas por tipo (/stats/nome e /stats/multi)
+QUERY_CACHE_SIZE = 4096
+
+# Proporção máxima de valores distintos para converter uma coluna textual em 'category'
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+
+# A partir deste número de registros a clusterização usa MiniBatchKMeans
+MINIBATCH_MIN_SAMPLES = 5000
+
 # Colunas consideradas sensíveis e que não podem ser usadas em clusterização/agregação
 SENSITIVE_COLUMNS = [
     "CPF",
@@ -1,14 +1,42 @@
+import asyncio
 import os
-from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Tuple, FrozenSet, Callable
 
+import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 from . import config
 from . import services
 
 
+# serializa os treinos (startup e /fit) para não intercalar escritas no estado
+_fit_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Dispara o treino automático em segundo plano, EXCETO quando estiver no CI,
+    para que o servidor aceite requisições imediatamente.
+    """
+    task: Optional[asyncio.Task] = None
+    if os.getenv("CI") == "true":
+        print("[startup] Modo CI detectado — ignorando treinamento automático.")
+    else:
+        task = asyncio.create_task(_initial_fit())
+
+    yield
+
+    if task is not None and not task.done():
+        task.cancel()
+
+
 app = FastAPI(
     title="Aequitas Anonymizer API",
     description=(
@@ -16,6 +44,7 @@ app = FastAPI(
         "Retorna apenas resultados agregados, com k-anonymity e limites de consulta."
     ),
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 
@@ -56,25 +85,150 @@ class ClusterDetail(BaseModel):
     categorical_modes: Dict[str, Optional[str]]
 
 
+@dataclass(frozen=True, eq=False)
+class FittedSnapshot:
+    """
+    Resultado imutável de um treino e seus caches derivados. Cada
+    requisição lê um único snapshot, então um re-treino concorrente
+    nunca mistura dados de versões diferentes. As contagens memorizadas
+    vivem no próprio snapshot e são liberadas junto com ele.
+    """
+    df: pd.DataFrame
+    labels: pd.Series
+    agg: pd.DataFrame
+    numeric_cols: List[str]
+    categorical_cols: List[str]
+    n_clusters: int
+    lower_cols: Dict[str, np.ndarray]
+    name_counts: Dict[str, int]
+    multi_counts: Optional[pd.Series]
+    cluster_summaries: List[ClusterSummary]
+    cluster_details: Dict[int, ClusterDetail]
+    count_name: Callable[[str], int]
+    count_filters: Callable[[FrozenSet[Tuple[str, Any]]], int]
+    fit_version: int
+
+
 class AnonymizerState:
     def __init__(self) -> None:
-        self.df: Optional[pd.DataFrame] = None
-        self.cluster_labels: Optional[pd.Series] = None
-        self.agg_clusters: Optional[pd.DataFrame] = None
-        self.numeric_cols: List[str] = []
-        self.categorical_cols: List[str] = []
-        self.n_clusters: Optional[int] = None
+        # trocado atomicamente a cada treino publicado
+        self.current: Optional[FittedSnapshot] = None
+        self.fit_version: int = 0
 
 
 state = AnonymizerState()
 
 
-def _ensure_fitted():
-    if state.df is None or state.cluster_labels is None or state.agg_clusters is None:
+def _current_or_503() -> FittedSnapshot:
+    snap = state.current
+    if snap is None:
         raise HTTPException(
             status_code=503,
             detail="Modelo ainda não foi treinado. Chame o endpoint /fit primeiro.",
         )
+    return snap
+
+
+def _build_cluster_responses(
+    agg: pd.DataFrame,
+    numeric_cols: List[str],
+    categorical_cols: List[str],
+) -> Tuple[List[ClusterSummary], Dict[int, ClusterDetail]]:
+    """
+    Monta, uma única vez por treino, as respostas de /clusters e
+    /clusters/{id} (apenas clusters que respeitam k-anonymity).
+    """
+    eligible = agg[agg["size"].to_numpy() >= config.K_ANONYMITY]
+
+    ids = eligible.index.to_numpy()
+    sizes = eligible["size"].to_numpy()
+    summaries = [
+        ClusterSummary(cluster_id=int(i), size=int(size))
+        for i, size in zip(ids, sizes)
+    ]
+
+    # valores nativos extraídos uma vez por coluna, prontos para serialização
+    means = {
+        col: eligible[f"mean_{col}"].to_numpy(dtype=float).tolist()
+        for col in numeric_cols
+        if f"mean_{col}" in eligible.columns
+    }
+    modes = {
+        col: [None if pd.isna(v) else str(v) for v in eligible[f"mode_{col}"].tolist()]
+        for col in categorical_cols
+        if f"mode_{col}" in eligible.columns
+    }
+
+    details: Dict[int, ClusterDetail] = {}
+    for pos, summary in enumerate(summaries):
+        details[summary.cluster_id] = ClusterDetail(
+            cluster_id=summary.cluster_id,
+            size=summary.size,
+            numeric_means={col: values[pos] for col, values in means.items()},
+            categorical_modes={col: values[pos] for col, values in modes.items()},
+        )
+
+    return summaries, details
+
+
+def _update_state(
+    df: pd.DataFrame,
+    labels: pd.Series,
+    agg: pd.DataFrame,
+    numeric_cols: List[str],
+    categorical_cols: List[str],
+    n_clusters: int,
+) -> None:
+    """
+    Monta o snapshot de um treino, junto com os caches derivados (colunas
+    em minúsculas, tabelas de contagem e respostas de clusters), e o
+    publica no estado global com uma única atribuição.
+    """
+    summaries, details = _build_cluster_responses(agg, numeric_cols, categorical_cols)
+    lower_cols = services.build_lower_cols(df)
+    name_counts = services.build_name_counts(lower_cols)
+    multi_counts = services.build_multi_counts(df, lower_cols)
+    count_name, count_filters = _make_query_caches(df, lower_cols, name_counts, multi_counts)
+
+    state.current = FittedSnapshot(
+        df=df,
+        labels=labels,
+        agg=agg,
+        numeric_cols=numeric_cols,
+        categorical_cols=categorical_cols,
+        n_clusters=n_clusters,
+        lower_cols=lower_cols,
+        name_counts=name_counts,
+        multi_counts=multi_counts,
+        cluster_summaries=summaries,
+        cluster_details=details,
+        count_name=count_name,
+        count_filters=count_filters,
+        fit_version=state.fit_version + 1,
+    )
+    state.fit_version += 1
+
+
+def _make_query_caches(
+    df: pd.DataFrame,
+    lower_cols: Dict[str, np.ndarray],
+    name_counts: Dict[str, int],
+    multi_counts: Optional[pd.Series],
+) -> Tuple[Callable[[str], int], Callable[[FrozenSet[Tuple[str, Any]]], int]]:
+    """
+    Cria as contagens memorizadas de /stats/nome e /stats/multi de um treino.
+    Referenciam apenas os dados desse treino (e não o snapshot), então o
+    cache é descartado junto com o snapshot que o guarda.
+    """
+    @lru_cache(maxsize=config.QUERY_CACHE_SIZE)
+    def count_name(name_lower: str) -> int:
+        return services.count_by_name(df, name_lower, name_counts)
+
+    @lru_cache(maxsize=config.QUERY_CACHE_SIZE)
+    def count_filters(filters: FrozenSet[Tuple[str, Any]]) -> int:
+        return services.count_by_filters(df, lower_cols, multi_counts, **dict(filters))
+
+    return count_name, count_filters
 
 
 def apply_privacy_rules(count: int) -> Optional[Dict[str, Any]]:
@@ -106,56 +260,83 @@ def apply_privacy_rules(count: int) -> Optional[Dict[str, Any]]:
     return None
 
 
-@app.on_event("startup")
-def startup_event():
+def _train(requested_clusters: Optional[int] = None) -> Tuple[int, int]:
     """
-    Carrega dados e treina automaticamente, EXCETO quando estiver no CI.
+    Pipeline completo (bloqueante): carrega o CSV, treina e publica o estado.
+    Retorna o número de registros e o número efetivo de clusters.
     """
-    if os.getenv("CI") == "true":
-        print("[startup] Modo CI detectado — ignorando treinamento automático.")
-        return
+    df = services.load_data(config.DATA_PATH)
+    processed, index, numeric_cols, categorical_cols = services.preprocess(df)
+    labels, n_clusters = services.clusterize(
+        processed,
+        index,
+        requested_clusters=requested_clusters,
+    )
+    agg = services.aggregate_clusters(df, labels, numeric_cols, categorical_cols)
+
+    _update_state(df, labels, agg, numeric_cols, categorical_cols, n_clusters)
+
+    try:
+        services.save_fitted(
+            config.MODEL_CACHE_DIR,
+            config.DATA_PATH,
+            df,
+            labels,
+            agg,
+            numeric_cols,
+            categorical_cols,
+            n_clusters,
+        )
+    except Exception as e:
+        print(f"[fit] Aviso: não foi possível persistir o treino. Motivo: {e}")
+
+    return len(df), n_clusters
+
+
+def _restore() -> bool:
+    """
+    Restaura o último treino persistido, se o CSV não mudou desde então.
+    """
+    try:
+        fitted = services.load_fitted(config.MODEL_CACHE_DIR, config.DATA_PATH)
+    except Exception as e:
+        print(f"[startup] Aviso: cache de treino inválido, re-treinando. Motivo: {e}")
+        return False
 
+    if fitted is None:
+        return False
+
+    _update_state(*fitted)
+    return True
+
+
+async def _initial_fit() -> None:
+    """
+    Treino automático em segundo plano na inicialização (ou restauração do
+    último treino persistido); até terminar, os endpoints de consulta
+    respondem 503.
+    """
     try:
-        df = services.load_data(config.DATA_PATH)
-        processed, numeric_cols, categorical_cols = services.preprocess(df)
-        labels, n_clusters = services.clusterize(processed)
-
-        agg = services.aggregate_clusters(df, labels, numeric_cols, categorical_cols)
-
-        state.df = df
-        state.cluster_labels = labels
-        state.agg_clusters = agg
-        state.numeric_cols = numeric_cols
-        state.categorical_cols = categorical_cols
-        state.n_clusters = n_clusters
+        async with _fit_lock:
+            if not await run_in_threadpool(_restore):
+                await run_in_threadpool(_train)
     except Exception as e:
         print(f"[startup] Aviso: não foi possível treinar automaticamente. Motivo: {e}")
 
 
 @app.post("/fit", response_model=FitResponse)
-def fit_model(body: FitRequest):
+async def fit_model(body: FitRequest):
     """
     Recarrega o CSV e re-treina o modelo de clusterização.
     Pode receber opcionalmente o número de clusters desejado.
+    O treino roda fora do event loop; treinos simultâneos são serializados.
     """
     try:
-        df = services.load_data(config.DATA_PATH)
-        processed, numeric_cols, categorical_cols = services.preprocess(df)
-        labels, n_clusters = services.clusterize(
-            processed,
-            requested_clusters=body.n_clusters,
-        )
-        agg = services.aggregate_clusters(df, labels, numeric_cols, categorical_cols)
-
-        state.df = df
-        state.cluster_labels = labels
-        state.agg_clusters = agg
-        state.numeric_cols = numeric_cols
-        state.categorical_cols = categorical_cols
-        state.n_clusters = n_clusters
+        async with _fit_lock:
+            num_records, n_clusters = await run_in_threadpool(_train, body.n_clusters)
 
         return FitResponse(
-            num_records=len(df),
+            num_records=num_records,
             num_clusters=n_clusters,
             k_anonymity=config.K_ANONYMITY,
             max_results=config.MAX_RESULTS,
@@ -165,17 +346,15 @@ def fit_model(body: FitRequest):
 
 
 @app.get("/stats/nome/{nome}", response_model=NameStatsResponse)
-def stats_by_name(nome: str):
+def stats_by_name(nome: str, snap: FittedSnapshot = Depends(_current_or_503)):
     """
     Devolve uma resposta agregada do tipo:
     "existem X pessoas com o nome Juan", respeitando:
     - k-anonymity (mínimo 10)
     - limite máximo de 4000 resultados
     """
-    _ensure_fitted()
-
     try:
-        count = services.count_by_name(state.df, nome)
+        count = snap.count_name(nome.lower())
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -211,6 +390,7 @@ def stats_multi(
     sexo: Optional[str] = None,
     ocupacao: Optional[str] = None,
     cidade: Optional[str] = None,
+    snap: FittedSnapshot = Depends(_current_or_503),
 ):
     """
     Consulta cruzada com múltiplos atributos:
@@ -224,8 +404,6 @@ def stats_multi(
     - k-anonymity (mínimo 10)
     - limite máximo de 4000 resultados
     """
-    _ensure_fitted()
-
     filters = {
         "NOME": nome,
         "IDADE": idade,
@@ -234,7 +412,9 @@ def stats_multi(
         "CIDADE": cidade,
     }
 
-    count = services.count_by_filters(state.df, **filters)
+    count = snap.count_filters(
+        frozenset((k, v) for k, v in filters.items() if v is not None),
+    )
 
     if count == 0:
         return MultiStatsResponse(
@@ -262,30 +442,16 @@ def stats_multi(
 
 
 @app.get("/clusters", response_model=List[ClusterSummary])
-def list_clusters():
+def list_clusters(snap: FittedSnapshot = Depends(_current_or_503)):
     """
     Lista os clusters com seus tamanhos (apenas agregados).
     Não retorna clusters menores que k-anonymity.
     """
-    _ensure_fitted()
-
-    summaries: List[ClusterSummary] = []
-    for cluster_id, row in state.agg_clusters.iterrows():
-        size = int(row["size"])
-        if size < config.K_ANONYMITY:
-            continue
-        summaries.append(
-            ClusterSummary(
-                cluster_id=int(cluster_id),
-                size=size,
-            )
-        )
-
-    return summaries
+    return snap.cluster_summaries
 
 
 @app.get("/clusters/{cluster_id}", response_model=ClusterDetail)
-def cluster_detail(cluster_id: int):
+def cluster_detail(cluster_id: int, snap: FittedSnapshot = Depends(_current_or_503)):
     """
     Devolve detalhes agregados de um cluster específico:
     - tamanho
@@ -293,37 +459,14 @@ def cluster_detail(cluster_id: int):
     - modas categóricas
     (respeitando k-anonymity)
     """
-    _ensure_fitted()
+    detail = snap.cluster_details.get(cluster_id)
+    if detail is not None:
+        return detail
 
-    if cluster_id not in state.agg_clusters.index:
+    if cluster_id not in snap.agg.index:
         raise HTTPException(status_code=404, detail="Cluster não encontrado.")
 
-    row = state.agg_clusters.loc[cluster_id]
-    size = int(row["size"])
-
-    if size < config.K_ANONYMITY:
-        raise HTTPException(
-            status_code=403,
-            detail="Cluster muito pequeno para divulgação (k-anonymity).",
-        )
-
-    numeric_means: Dict[str, Any] = {}
-    categorical_modes: Dict[str, Any] = {}
-
-    for col in state.numeric_cols:
-        key = f"mean_{col}"
-        if key in row:
-            numeric_means[col] = float(row[key])
-
-    for col in state.categorical_cols:
-        key = f"mode_{col}"
-        if key in row:
-            value = row[key]
-            categorical_modes[col] = None if pd.isna(value) else str(value)
-
-    return ClusterDetail(
-        cluster_id=int(cluster_id),
-        size=size,
-        numeric_means=numeric_means,
-        categorical_modes=categorical_modes,
+    raise HTTPException(
+        status_code=403,
+        detail="Cluster muito pequeno para divulgação (k-anonymity).",
     )
@@ -1,13 +1,39 @@
+import json
 from pathlib import Path
 from typing import Tuple, List, Dict, Any, Optional
 
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from scipy import sparse
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 from . import config
 
 
+# Colunas textuais usadas em filtros de consulta (comparação case-insensitive)
+TEXT_FILTER_COLUMNS = ("NOME", "SEXO", "OCUPACAO", "CIDADE")
+
+# Tipos explícitos na leitura do CSV (evita inferência e objetos Python por célula).
+# IDADE é float para tolerar valores ausentes.
+COLUMN_DTYPES = {
+    "NOME": "string",
+    "SEXO": "category",
+    "IDADE": "float64",
+    "OCUPACAO": "category",
+    "END_RESIDENCIAL": "string",
+}
+
+# Colunas sensíveis que nunca são lidas (NOME alimenta /stats e
+# END_RESIDENCIAL a coluna CIDADE; as demais não têm uso algum)
+SKIPPED_COLUMNS = [
+    c for c in config.SENSITIVE_COLUMNS if c not in ("NOME", "END_RESIDENCIAL")
+]
+
+# Colunas da tabela pré-agregada de contagens (NOME fica de fora: alta cardinalidade)
+MULTI_COUNT_COLUMNS = ("SEXO", "OCUPACAO", "CIDADE", "IDADE")
+
+
 def extract_city(address: Any) -> Optional[str]:
     """
     Extrai uma 'cidade/bairro' simplificada a partir do campo END_RESIDENCIAL.
@@ -35,6 +61,97 @@ def extract_city(address: Any) -> Optional[str]:
     return part or None
 
 
+def extract_cities(addresses: pd.Series) -> pd.Series:
+    """
+    Versão vetorizada de extract_city para uma coluna inteira,
+    usando os métodos de string do pandas em vez de apply por linha.
+    """
+    # armazenamento "python": strip() e \s seguem str.isspace(), como em
+    # extract_city (o backend pyarrow/RE2 só reconhece espaços ASCII)
+    s = addresses.astype(pd.StringDtype("python"))
+    s = s.where(s.str.strip() != "")
+
+    # texto depois do primeiro '–' (ou o endereço inteiro, se não houver)
+    after_dash = s.str.split("–", n=1, expand=True).iloc[:, -1].fillna(s).str.strip()
+
+    # normaliza os fragmentos separados por vírgula como ", "
+    part = after_dash.str.replace(r"\s*,\s*", ", ", regex=True)
+
+    # remover possível UF no final (ex: ", RJ", ", ES")
+    fragments = part.str.rsplit(", ", n=1, expand=True)
+    if fragments.shape[1] == 2:
+        tail = fragments[1]
+        is_uf = (tail.str.len().eq(2) & tail.str.isalpha()).fillna(False).astype(bool)
+        part = fragments[0].where(is_uf, part)
+
+    return part.where(part != "")
+
+
+# Incrementar quando a leitura do CSV mudar de forma não coberta por
+# COLUMN_DTYPES/SKIPPED_COLUMNS (invalida o cache Parquet)
+READ_CACHE_VERSION = 1
+
+
+def _csv_fingerprint(csv_path: Path) -> Dict[str, Any]:
+    stat = csv_path.stat()
+    return {
+        "csv_path": str(csv_path.resolve()),
+        "csv_mtime": stat.st_mtime,
+        "csv_size": stat.st_size,
+    }
+
+
+def _read_fingerprint(csv_path: Path) -> Dict[str, Any]:
+    """
+    Identifica o CSV de origem e as opções de leitura que moldam o df.
+    """
+    return {
+        **_csv_fingerprint(csv_path),
+        "read_version": READ_CACHE_VERSION,
+        "column_dtypes": COLUMN_DTYPES,
+        "skipped_columns": SKIPPED_COLUMNS,
+    }
+
+
+def _matches_fingerprint(meta_path: Path, fingerprint: Dict[str, Any]) -> bool:
+    if not meta_path.exists():
+        return False
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    return all(meta.get(key) == value for key, value in fingerprint.items())
+
+
+def _read_csv(csv_path: Path) -> pd.DataFrame:
+    """
+    Lê o CSV com o engine pyarrow, tipos explícitos e sem as colunas
+    sensíveis não utilizadas. Mantém um cache Parquet ao lado do CSV,
+    reaproveitado enquanto o CSV (data de modificação e tamanho) e as
+    opções de leitura forem os mesmos registrados no arquivo .meta.json.
+    """
+    parquet_path = csv_path.with_suffix(".parquet")
+    meta_path = csv_path.with_suffix(".meta.json")
+    fingerprint = _read_fingerprint(csv_path)
+
+    if parquet_path.exists() and _matches_fingerprint(meta_path, fingerprint):
+        return pd.read_parquet(parquet_path)
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = [c for c in header if c not in SKIPPED_COLUMNS]
+    dtypes = {c: t for c, t in COLUMN_DTYPES.items() if c in usecols}
+
+    df = pd.read_csv(csv_path, engine="pyarrow", usecols=usecols, dtype=dtypes)
+
+    try:
+        # o .meta.json é gravado por último: sem ele, o Parquet é ignorado
+        meta_path.unlink(missing_ok=True)
+        df.to_parquet(parquet_path)
+        meta_path.write_text(json.dumps(fingerprint), encoding="utf-8")
+    except OSError as e:
+        # o cache é opcional: o CSV continua sendo a fonte de verdade
+        print(f"[load_data] Aviso: não foi possível gravar o cache Parquet. Motivo: {e}")
+
+    return df
+
+
 def load_data(csv_path: Path) -> pd.DataFrame:
     """
     Carrega o dataset a partir de um arquivo CSV.
@@ -43,21 +160,40 @@ def load_data(csv_path: Path) -> pd.DataFrame:
     if not csv_path.exists():
         raise FileNotFoundError(f"Arquivo de dados não encontrado em: {csv_path}")
 
-    df = pd.read_csv(csv_path)
+    df = _read_csv(csv_path)
 
     if df.empty:
         raise ValueError("O dataset está vazio.")
 
     # cria coluna CIDADE a partir de END_RESIDENCIAL, se existir
     if "END_RESIDENCIAL" in df.columns and "CIDADE" not in df.columns:
-        df["CIDADE"] = df["END_RESIDENCIAL"].apply(extract_city)
+        df["CIDADE"] = extract_cities(df["END_RESIDENCIAL"])
+
+    # colunas textuais de baixa cardinalidade -> dtype 'category'
+    for col in df.columns:
+        if col in config.SENSITIVE_COLUMNS or not _is_text_dtype(df[col]):
+            continue
+        if _is_low_cardinality(df[col]):
+            df[col] = df[col].astype("category")
 
     return df
 
 
+def _is_text_dtype(series: pd.Series) -> bool:
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def _is_low_cardinality(series: pd.Series) -> bool:
+    if series.empty:
+        return False
+    return series.nunique(dropna=True) / len(series) < config.CATEGORICAL_MAX_UNIQUE_RATIO
+
+
 def detect_column_types(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
     """
     Separa colunas numéricas e categóricas de forma automática.
+    Colunas textuais de alta cardinalidade (quase um valor por pessoa) ficam
+    de fora: a moda de um cluster seria o valor exato de um indivíduo.
     """
     numeric_cols = [
         col for col in df.columns
@@ -66,56 +202,68 @@ def detect_column_types(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
 
     categorical_cols = [
         col for col in df.columns
-        if df[col].dtype == "object"
+        if isinstance(df[col].dtype, pd.CategoricalDtype)
+        or (_is_text_dtype(df[col]) and _is_low_cardinality(df[col]))
     ]
 
     return numeric_cols, categorical_cols
 
 
-def preprocess(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str], List[str]]:
+def _fill_unknown(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Preenche valores ausentes com 'UNKNOWN', registrando a categoria nova
+    nas colunas do tipo 'category' (fillna exige categoria existente).
+    Espera um recorte de colunas já desacoplado do df original.
+    """
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and "UNKNOWN" not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories("UNKNOWN")
+    return df.fillna("UNKNOWN")
+
+
+def preprocess(df: pd.DataFrame) -> Tuple[sparse.csr_matrix, pd.Index, List[str], List[str]]:
     """
     Pré-processa o dataframe:
     - remove colunas sensíveis das features de ML
     - identifica colunas numéricas e categóricas
-    - aplica one-hot encoding nas categóricas
-    - normaliza os dados numéricos
+    - aplica one-hot encoding esparso nas categóricas
+    - normaliza os dados
+    Retorna a matriz esparsa normalizada (CSR, float32), o índice das
+    linhas e as listas de colunas numéricas e categóricas.
     """
     # removendo colunas sensíveis do conjunto de features
-    df_features = df.copy()
-    cols_to_drop = [c for c in config.SENSITIVE_COLUMNS if c in df_features.columns]
-    df_features = df_features.drop(columns=cols_to_drop, errors="ignore")
+    cols_to_drop = [c for c in config.SENSITIVE_COLUMNS if c in df.columns]
+    df_features = df.drop(columns=cols_to_drop, errors="ignore")
 
     numeric_cols, categorical_cols = detect_column_types(df_features)
 
+    blocks: List[sparse.csr_matrix] = []
+
     # Numéricos
-    df_numeric = df_features[numeric_cols].copy() if numeric_cols else pd.DataFrame()
+    if numeric_cols:
+        numeric = df_features[numeric_cols].fillna(0).to_numpy(dtype=np.float32)
+        blocks.append(sparse.csr_matrix(numeric))
 
-    # Categóricos -> one-hot encoding
+    # Categóricos -> one-hot encoding esparso
     if categorical_cols:
-        df_cat = pd.get_dummies(
-            df_features[categorical_cols].fillna("UNKNOWN"),
-            drop_first=False,
+        encoder = OneHotEncoder(
+            handle_unknown="ignore",
+            sparse_output=True,
+            dtype=np.float32,
         )
-    else:
-        df_cat = pd.DataFrame()
+        blocks.append(encoder.fit_transform(_fill_unknown(df_features[categorical_cols])))
 
-    # Concatena tudo
-    processed = pd.concat([df_numeric, df_cat], axis=1)
-
-    if processed.empty:
+    if not blocks:
         raise ValueError("Não há colunas utilizáveis para clusterização.")
 
-    processed = processed.fillna(0)
+    processed = sparse.hstack(blocks, format="csr")
 
-    # Normalização (StandardScaler)
-    scaler = StandardScaler()
-    processed_scaled = pd.DataFrame(
-        scaler.fit_transform(processed),
-        columns=processed.columns,
-        index=processed.index,
-    )
+    # Normalização (StandardScaler) sem centralizar, o que preserva a
+    # esparsidade; a translação não altera as distâncias usadas pelo KMeans
+    scaler = StandardScaler(with_mean=False)
+    processed_scaled = scaler.fit_transform(processed).astype(np.float32, copy=False)
 
-    return processed_scaled, numeric_cols, categorical_cols
+    return processed_scaled, df_features.index, numeric_cols, categorical_cols
 
 
 def choose_n_clusters(n_samples: int, requested: int | None = None) -> int:
@@ -135,11 +283,13 @@ def choose_n_clusters(n_samples: int, requested: int | None = None) -> int:
 
 
 def clusterize(
-    processed_data: pd.DataFrame,
+    processed_data: sparse.csr_matrix,
+    index: pd.Index,
     requested_clusters: int | None = None,
 ) -> Tuple[pd.Series, int]:
     """
-    Executa KMeans sobre os dados pré-processados.
+    Executa KMeans sobre os dados pré-processados
+    (MiniBatchKMeans para datasets grandes).
     Retorna:
     - labels (cluster_id para cada linha)
     - número efetivo de clusters usados
@@ -147,14 +297,24 @@ def clusterize(
     n_samples = processed_data.shape[0]
     n_clusters = choose_n_clusters(n_samples, requested_clusters)
 
-    model = KMeans(
-        n_clusters=n_clusters,
-        random_state=42,
-        n_init=10,
-    )
+    if n_samples > config.MINIBATCH_MIN_SAMPLES:
+        model = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            random_state=42,
+            n_init=3,
+            batch_size=1024,
+            max_iter=100,
+        )
+    else:
+        model = KMeans(
+            n_clusters=n_clusters,
+            random_state=42,
+            n_init="auto",
+            algorithm="elkan",
+        )
 
     labels = model.fit_predict(processed_data)
-    return pd.Series(labels, index=processed_data.index, name="cluster_id"), n_clusters
+    return pd.Series(labels, index=index, name="cluster_id"), n_clusters
 
 
 def aggregate_clusters(
@@ -170,46 +330,249 @@ def aggregate_clusters(
     - moda para colunas categóricas
     Colunas sensíveis já foram removidas da lista de features.
     """
-    df = df_original.copy()
-    df["cluster_id"] = labels
+    # agrupa diretamente pelos rótulos, sem copiar o df para anexar cluster_id
+    groups = df_original.groupby(labels.to_numpy(), observed=True)
+    numeric_present = [c for c in numeric_cols if c in df_original.columns]
+    categorical_present = [c for c in categorical_cols if c in df_original.columns]
+
+    parts: List[pd.DataFrame] = [groups.size().rename("size").to_frame()]
+
+    # Médias numéricas
+    if numeric_present:
+        parts.append(
+            groups[numeric_present].mean().astype(float).add_prefix("mean_")
+        )
+
+    # Moda para categóricas
+    if categorical_present:
+        label_values = labels.to_numpy()
+        parts.append(pd.DataFrame({
+            f"mode_{col}": _group_modes(df_original[col], label_values)
+            for col in categorical_present
+        }))
+
+    agg_df = pd.concat(parts, axis=1)
+    agg_df.index = agg_df.index.astype(int)
+    agg_df.index.name = "cluster_id"
+    return agg_df
+
+
+def _group_modes(values: pd.Series, labels: np.ndarray) -> pd.Series:
+    """
+    Moda de 'values' em cada cluster numa única passada: conta os pares
+    (cluster, valor) e pega o mais frequente por cluster (empate -> menor valor).
+    """
+    counts = values.groupby([labels, values], observed=True).size()
+    top = counts.groupby(level=0).idxmax()
+    return top.map(lambda pair: pair[1])
+
 
-    groups = df.groupby("cluster_id")
-    rows: List[Dict[str, Any]] = []
+# Incrementar quando o formato/conteúdo do treino persistido mudar
+MODEL_CACHE_VERSION = 1
 
-    for cluster_id, g in groups:
-        row: Dict[str, Any] = {
-            "cluster_id": int(cluster_id),
-            "size": int(len(g)),
-        }
+FittedModel = Tuple[pd.DataFrame, pd.Series, pd.DataFrame, List[str], List[str], int]
 
-        # Médias numéricas
-        for col in numeric_cols:
-            if col in g.columns:
-                row[f"mean_{col}"] = float(g[col].mean(skipna=True))
 
-        # Moda para categóricas
-        for col in categorical_cols:
-            if col in g.columns:
-                mode = g[col].mode(dropna=True)
-                row[f"mode_{col}"] = mode.iloc[0] if not mode.empty else None
+def _model_fingerprint(csv_path: Path) -> Dict[str, Any]:
+    """
+    Identifica o CSV, as opções de leitura e a configuração que moldam o
+    treino; qualquer mudança invalida o treino persistido.
+    """
+    return {
+        **_read_fingerprint(csv_path),
+        "version": MODEL_CACHE_VERSION,
+        "sensitive_columns": config.SENSITIVE_COLUMNS,
+        "categorical_max_unique_ratio": config.CATEGORICAL_MAX_UNIQUE_RATIO,
+        "minibatch_min_samples": config.MINIBATCH_MIN_SAMPLES,
+    }
+
+
+def save_fitted(
+    cache_dir: Path,
+    csv_path: Path,
+    df: pd.DataFrame,
+    labels: pd.Series,
+    agg: pd.DataFrame,
+    numeric_cols: List[str],
+    categorical_cols: List[str],
+    n_clusters: int,
+) -> None:
+    """
+    Persiste o resultado de um treino em disco (Parquet + meta.json),
+    associado à data de modificação e ao tamanho do CSV de origem.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    meta_path = cache_dir / "meta.json"
 
-        rows.append(row)
+    # meta.json é gravado por último: sem ele, o cache é ignorado
+    meta_path.unlink(missing_ok=True)
 
-    agg_df = pd.DataFrame(rows).set_index("cluster_id")
-    return agg_df
+    df.to_parquet(cache_dir / "df.parquet")
+    labels.to_frame().to_parquet(cache_dir / "labels.parquet")
+    agg.to_parquet(cache_dir / "agg_clusters.parquet")
+
+    meta = {
+        **_model_fingerprint(csv_path),
+        "n_clusters": n_clusters,
+        "numeric_cols": numeric_cols,
+        "categorical_cols": categorical_cols,
+    }
+    meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+
+def load_fitted(cache_dir: Path, csv_path: Path) -> Optional[FittedModel]:
+    """
+    Carrega o treino persistido se ele corresponder ao CSV e à
+    configuração atuais. Retorna None quando não há cache válido.
+    """
+    meta_path = cache_dir / "meta.json"
+    if not csv_path.exists() or not _matches_fingerprint(meta_path, _model_fingerprint(csv_path)):
+        return None
+
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+
+    df = pd.read_parquet(cache_dir / "df.parquet")
+    labels = pd.read_parquet(cache_dir / "labels.parquet")["cluster_id"]
+    agg = pd.read_parquet(cache_dir / "agg_clusters.parquet")
+
+    # nunca divulga colunas que passaram a ser sensíveis após o treino
+    numeric_cols = [c for c in meta["numeric_cols"] if c not in config.SENSITIVE_COLUMNS]
+    categorical_cols = [c for c in meta["categorical_cols"] if c not in config.SENSITIVE_COLUMNS]
+
+    return (
+        df,
+        labels,
+        agg,
+        numeric_cols,
+        categorical_cols,
+        int(meta["n_clusters"]),
+    )
+
+
+def build_lower_cols(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    Pré-calcula, uma única vez por treino, as colunas textuais de filtro
+    em minúsculas, evitando repetir o lower() a cada consulta.
+    """
+    return {
+        col: df[col].astype(str).str.lower().to_numpy()
+        for col in TEXT_FILTER_COLUMNS
+        if col in df.columns
+    }
+
+
+def build_name_counts(lower_cols: Dict[str, np.ndarray]) -> Dict[str, int]:
+    """
+    Tabela hash nome (minúsculo) -> quantidade de registros, calculada a
+    partir do cache de colunas em minúsculas.
+    """
+    if "NOME" not in lower_cols:
+        return {}
+    counts = pd.Series(lower_cols["NOME"]).value_counts(dropna=True)
+    return {str(name): int(count) for name, count in counts.items()}
+
+
+def build_multi_counts(
+    df: pd.DataFrame,
+    lower_cols: Dict[str, np.ndarray],
+) -> Optional[pd.Series]:
+    """
+    Pré-agrega o tamanho de cada combinação de SEXO/OCUPACAO/CIDADE/IDADE,
+    permitindo responder /stats/multi (sem NOME) sem varrer o dataset.
+    Colunas textuais entram em minúsculas; numéricas, com o valor original.
+    """
+    keys: Dict[str, np.ndarray] = {}
+    for col in MULTI_COUNT_COLUMNS:
+        if col in lower_cols:
+            keys[col] = lower_cols[col]
+        elif col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            keys[col] = df[col].to_numpy()
+
+    if not keys:
+        return None
+
+    return (
+        pd.DataFrame(keys)
+        .groupby(list(keys), dropna=False, observed=True)
+        .size()
+        .sort_index()
+    )
+
+
+def _count_from_multi_counts(
+    multi_counts: pd.Series,
+    lower_cols: Dict[str, np.ndarray],
+    filters: Dict[str, Any],
+) -> Optional[int]:
+    """
+    Soma as contagens pré-agregadas para os filtros informados.
+    Retorna None quando os filtros não podem ser respondidos pela tabela.
+    """
+    levels: List[str] = []
+    values: List[Any] = []
+
+    for col, val in filters.items():
+        if col not in multi_counts.index.names:
+            return None
+        if col in lower_cols:
+            values.append(str(val).lower())
+        elif isinstance(val, str):
+            # texto contra coluna numérica: deixa a comparação para a máscara
+            return None
+        else:
+            values.append(val)
+        levels.append(col)
+
+    try:
+        return int(multi_counts.xs(tuple(values), level=levels).sum())
+    except KeyError:
+        return 0
+
+
+def _column_mask(
+    df: pd.DataFrame,
+    col: str,
+    val: Any,
+    lower_cols: Optional[Dict[str, np.ndarray]] = None,
+) -> np.ndarray:
+    """
+    Máscara booleana de igualdade para uma coluna, usando o cache de
+    colunas em minúsculas quando disponível.
+    """
+    if lower_cols is not None and col in lower_cols:
+        return lower_cols[col] == str(val).lower()
+
+    series = df[col]
+    if pd.api.types.is_numeric_dtype(series) and not isinstance(val, str):
+        # colunas numéricas (ex: IDADE) dispensam conversão para texto
+        return series.to_numpy() == val
 
+    return series.astype(str).str.lower().to_numpy() == str(val).lower()
 
-def count_by_name(df: pd.DataFrame, name: str) -> int:
+
+def count_by_name(
+    df: pd.DataFrame,
+    name: str,
+    name_counts: Optional[Dict[str, int]] = None,
+) -> int:
     """
     Conta quantas pessoas têm o nome informado.
     Pressupõe uma coluna 'NOME' no dataset.
+    Com a tabela 'name_counts' pré-calculada a consulta é O(1).
     """
     if "NOME" not in df.columns:
         raise ValueError("Coluna 'NOME' não encontrada no dataset.")
-    return int((df["NOME"].astype(str).str.lower() == name.lower()).sum())
+    if name_counts is not None:
+        return name_counts.get(name.lower(), 0)
+    return int(np.sum(_column_mask(df, "NOME", name)))
 
 
-def count_by_filters(df: pd.DataFrame, **filters) -> int:
+def count_by_filters(
+    df: pd.DataFrame,
+    lower_cols: Optional[Dict[str, np.ndarray]] = None,
+    multi_counts: Optional[pd.Series] = None,
+    **filters,
+) -> int:
     """
     Conta quantos registros atendem aos filtros cruzados.
     Exemplo de filtros:
@@ -218,20 +581,29 @@ def count_by_filters(df: pd.DataFrame, **filters) -> int:
     - SEXO="F"
     - OCUPACAO="Analista de Sistemas"
     - CIDADE="Laranjeiras"
+    Sem NOME, usa a tabela 'multi_counts' pré-agregada quando disponível.
     """
-    query = df.copy()
-
-    for col, val in filters.items():
-        if val is None:
-            continue
-        if col not in query.columns:
-            # ignora filtros para colunas inexistentes
-            continue
-
-        series = query[col].astype(str).str.lower()
-        query = query[series == str(val).lower()]
-
-        if query.empty:
+    # ignora filtros vazios ou para colunas inexistentes
+    active = {
+        col: val for col, val in filters.items()
+        if val is not None and col in df.columns
+    }
+
+    if multi_counts is not None and active:
+        count = _count_from_multi_counts(multi_counts, lower_cols or {}, active)
+        if count is not None:
+            return count
+
+    # máscara booleana única sobre o df original (sem cópias intermediárias)
+    mask = np.ones(len(df), dtype=bool)
+
+    for col, val in active.items():
+        mask &= _column_mask(df, col, val, lower_cols)
+
+        # só o resultado vazio permite parar cedo: cada filtro apenas reduz a
+        # contagem, então passar de MAX_RESULTS no meio do laço não garante
+        # que o total final também passe
+        if not mask.any():
             break
 
-    return len(query)
+    return int(mask.sum())